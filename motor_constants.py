@@ -1,4 +1,5 @@
-import math, logging
+import math, logging, functools, importlib
+from fractions import Fraction
 # Motor database, contains specifications for stepper motors.
 
 # R is coil resistance, Ohms
@@ -6,8 +7,66 @@ import math, logging
 # T is holding torque, Nm (be careful about units here)
 # I is nominal rated current, Amps
 
+_log = logging.getLogger(__name__)
+
+# The motor constants never change after loading, so results only depend
+# on the arguments and can be memoized across repeated tuning passes.
+@functools.lru_cache(maxsize=32)
+def _pwmgrad(k, fclk, steps, volts):
+    return int(math.ceil(k * fclk / (volts * steps)))
+
+# pwmofs has no irrational factors, so when the float quotient lands within
+# rounding error of a whole number it is re-checked exactly, with operands
+# taken from the shortest decimal repr of each float (the value as
+# configured or reported, e.g. 0.8 rather than 0.8000000000000000444).
+# Boundary cases this must keep:
+#   R=15.0  I=0.8  V=12 -> 374 (float and exact agree)
+#   R=2.0   I=0.28877038 V=12 -> 19 (quotient 18.00002)
+#   R=30.0  I=1.65133662 V=48 -> 386 (quotient 385.99994)
+#   ok42sth34-044e-200g I=2.2 V=12 -> 2057 (float ceil gives 2058)
+#   any motor, I=1e-7 -> 1
+def _exact(x):
+    return Fraction(repr(float(x)))
+
+def _pwmofs_exact(R_num, R_den, I, volts):
+    I, volts = _exact(I), _exact(volts)
+    return -(-(374 * R_num * I.numerator * volts.denominator)
+             // (R_den * I.denominator * volts.numerator))
+
+# Lists and arrays have a length or dimensions; plain and NumPy scalars don't.
+def _is_array(*args):
+    for a in args:
+        if hasattr(a, '__len__') or getattr(a, 'ndim', 0):
+            return True
+    return False
+
+# The cache is shared by all motors, so the diagnostics below are logged once
+# per unique set of inputs, not per stepper; MotorConstants.hysteresis logs
+# the result of every call.
+@functools.lru_cache(maxsize=32)
+def _hysteresis(R, L, I, extra, fclk, volts, tbl, toff):
+    verbose = _log.isEnabledFor(logging.INFO)
+    if verbose:
+        _log.info("autotune_tmc seting hysteresis based on %s V", volts)
+    tblank = 16.0 * (1.5 ** tbl) / fclk
+    tsd = (12.0 + 32.0 * toff) / fclk
+    dcoilblank = volts * tblank / L
+    dcoilsd = R * I * 2.0 * tsd / L
+    if verbose:
+        _log.info("dcoilblank = %f, dcoilsd = %f", dcoilblank, dcoilsd)
+    hysteresis = int(extra) + int(math.ceil(max(0.5 + ((dcoilblank + dcoilsd) * 2 * 248 * 32 / I) / 32 - 8, -2)))
+    htotal = 14 if hysteresis > 14 else hysteresis
+    hstrt = 1 if htotal < 1 else (8 if htotal > 8 else htotal)
+    hend = htotal - hstrt
+    hend = 12 if hend > 12 else hend
+    if verbose:
+        _log.info("hysteresis = %d, htotal = %d, hstrt = %d, hend = %d", hysteresis, htotal, hstrt, hend)
+    return hstrt - 1, hend + 3
+
 
 class MotorConstants:
+    __slots__ = ('printer', 'name', 'R', 'L', 'T', 'S', 'I', 'cbemf',
+                 '_pwmgrad_k', '_pwmofs_k', '_R_num', '_R_den')
     def __init__(self, config):
         self.printer = config.get_printer()
         self.name = config.get_name().split()[-1]
@@ -17,34 +76,60 @@ class MotorConstants:
         self.S = config.getint('steps_per_revolution', minval=0)
         self.I = config.getfloat('max_current', minval=0.)
         self.cbemf = self.T / (2.0 * self.I)
+        # Voltage and clock independent parts of pwmgrad and pwmofs
+        self._pwmgrad_k = self.cbemf * 2.0 * math.pi * 1.46 / 256.0
+        self._pwmofs_k = 374.0 * self.R
+        self._R_num, self._R_den = _exact(self.R).as_integer_ratio()
     def pwmgrad(self, fclk=12.5e6, steps=0, volts=24.0):
         if steps==0:
             steps=self.S
-        return int(math.ceil(self.cbemf * 2 * math.pi * fclk  * 1.46 / (volts * 256.0 * steps)))
+        return _pwmgrad(self._pwmgrad_k, fclk, steps, volts)
     def pwmofs(self, volts=24.0, current=0.0):
         I = current if current > 0.0 else self.I
-        return int(math.ceil(374 * self.R * I / volts))
+        # Not memoized: this float path is cheaper than an lru_cache lookup.
+        q = self._pwmofs_k * I / volts
+        n = math.ceil(q)
+        if 1e-9 * q < n - q < 1.0 - 1e-9 * q:
+            return n
+        return _pwmofs_exact(self._R_num, self._R_den, I, volts)
     # Maximum revolutions per second before PWM maxes out.
     def maxpwmrps(self, fclk=12.5e6, steps=0, volts=24.0, current=0.0):
         if steps==0:
             steps=self.S
         return (255 - self.pwmofs(volts, current)) / ( math.pi * self.pwmgrad(fclk, steps))
     def hysteresis(self, extra=0, fclk=12.5e6, volts=24.0, current=0.0, tbl=1, toff=0):
+        if _is_array(extra, fclk, volts, current, tbl, toff):
+            return self.hysteresis_batch(extra, fclk, volts, current, tbl, toff)
         I = current if current > 0.0 else self.I
-        logging.info("autotune_tmc seting hysteresis based on %s V", volts)
+        hstrt, hend = _hysteresis(self.R, self.L, I, extra, fclk, volts, tbl, toff)
+        if _log.isEnabledFor(logging.INFO):
+            _log.info("autotune_tmc motor %s hysteresis at %s V: register hstrt = %d, hend = %d",
+                      self.name, volts, hstrt, hend)
+        return hstrt, hend
+    # Same as hysteresis(), but accepts arrays for any argument and
+    # evaluates the whole (broadcast) grid of operating points at once.
+    def hysteresis_batch(self, extra=0, fclk=12.5e6, volts=24.0, current=0.0, tbl=1, toff=0):
+        np = self._import_numpy()
+        extra, fclk, volts, current, tbl, toff = (
+            np.asarray(a) for a in (extra, fclk, volts, current, tbl, toff))
+        I = np.where(current > 0.0, current, self.I)
         tblank = 16.0 * (1.5 ** tbl) / fclk
         tsd = (12.0 + 32.0 * toff) / fclk
         dcoilblank = volts * tblank / self.L
         dcoilsd = self.R * I * 2.0 * tsd / self.L
-        logging.info("dcoilblank = %f, dcoilsd = %f", dcoilblank, dcoilsd)
-        hysteresis = extra + int(math.ceil(max(0.5 + ((dcoilblank + dcoilsd) * 2 * 248 * 32 / I) / 32 - 8, -2)))
-        htotal = min(hysteresis, 14)
-        hstrt = max(min(htotal, 8), 1)
-        hend = min(htotal - hstrt, 12)
-        logging.info("hysteresis = %d, htotal = %d, hstrt = %d, hend = %d", hysteresis, htotal, hstrt, hend)
+        hysteresis = extra + np.ceil(np.maximum(0.5 + ((dcoilblank + dcoilsd) * 2 * 248 * 32 / I) / 32 - 8, -2)).astype(np.int32)
+        htotal = np.minimum(hysteresis, 14)
+        hstrt = np.clip(htotal, 1, 8)
+        hend = np.minimum(htotal - hstrt, 12)
         return hstrt - 1, hend + 3
+    def _import_numpy(self):
+        try:
+            return importlib.import_module('numpy')
+        except ImportError:
+            raise self.printer.command_error(
+                "Failed to import `numpy` module, make sure it was "
+                "installed via `~/klippy-env/bin/pip install`")
 
 
 def load_config_prefix(config):
     return MotorConstants(config)
-